@@ -1,3 +1,5 @@
+import random
+
 from faker import Faker
 from sqlalchemy import delete, insert, select, update
 
@@ -7,6 +9,22 @@ from models import Student
 faker = Faker(["ja-JP"])
 
 
+def make_rows(n):
+    """insert 用の生徒データを n 件生成する
+
+    NOTE: 名前と住所は insert する件数分だけ faker で生成し、数値は faker を通さずに random で生成する
+    """
+    return [
+        {
+            "name": faker.name(),
+            "gender": random.randint(1, 2),
+            "address": faker.address(),
+            "score": random.randint(0, 100),
+        }
+        for _ in range(n)
+    ]
+
+
 def test_select():
     """生徒の一覧を出力する
 
@@ -15,30 +33,28 @@ def test_select():
     ref: https://docs.sqlalchemy.org/en/20/core/selectable.html
     """  # noqa
     with Session() as session:
-        stmt = select(Student)
+        # NOTE: yield_per により全件をメモリに載せずに 500 件ずつフェッチする
+        stmt = select(Student.id, Student.name).execution_options(yield_per=500)
         result = session.execute(stmt)
-        students = result.all()
-        print(f"### students[{students}]")
-        for (student,) in students:
-            print(f"### student id[{student.id}] name[{student.name}]")
+        for id, name in result:
+            print(f"### student id[{id}] name[{name}]")
 
 
 def test_insert():
-    """生徒を追加する
+    """生徒を複数追加する
 
     ref: https://docs.sqlalchemy.org/en/20/tutorial/data_insert.html
     ref: https://docs.sqlalchemy.org/en/20/orm/queryguide/dml.html#orm-bulk-insert-statements
     ref: https://docs.sqlalchemy.org/en/20/core/dml.html#sqlalchemy.sql.expression.insert
+
+    NOTE: `execute()` の第2引数に dict の配列を渡すと executemany となり、
+          1件ずつ insert するよりも DB との往復回数が少なくなる
+    NOTE: `Session.begin()` を使うと with ブロックを抜ける際にまとめて1回だけ commit する
     """  # noqa
-    with Session() as session:
-        stmt = insert(Student).values(
-            name=faker.name(),
-            gender=faker.pyint(min_value=1, max_value=2),
-            address=faker.address(),
-            score=faker.pyint(min_value=0, max_value=100),
-        )
-        session.execute(stmt)
-        session.commit()
+    # NOTE: データの生成はトランザクションを開始する前に済ませておく
+    students = make_rows(10)
+    with Session.begin() as session:
+        session.execute(insert(Student), students)
 
 
 def test_update():
@@ -48,16 +64,17 @@ def test_update():
     ref: https://docs.sqlalchemy.org/en/20/orm/queryguide/dml.html#orm-update-and-delete-with-custom-where-criteria
     ref: https://docs.sqlalchemy.org/en/20/core/dml.html#sqlalchemy.sql.expression.update
     """  # noqa
-    with Session() as session:
+    with Session.begin() as session:
         stmt = (
             update(Student)
             .values(
                 name=f"UPDATE S{faker.name()}",
+                # 楽観的ロックの version_id (ref: models.py::Student)
+                version_id=Student.version_id + 1,
             )
             .where(Student.id == 1)
         )
         session.execute(stmt)
-        session.commit()
 
 
 def test_delete():
@@ -67,7 +84,6 @@ def test_delete():
     ref: https://docs.sqlalchemy.org/en/20/orm/queryguide/dml.html#orm-update-and-delete-with-custom-where-criteria
     ref: https://docs.sqlalchemy.org/en/20/core/dml.html#sqlalchemy.sql.expression.delete
     """  # noqa
-    with Session() as session:
+    with Session.begin() as session:
         stmt = delete(Student).where(Student.id == 1)
         session.execute(stmt)
-        session.commit()
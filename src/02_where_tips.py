@@ -1,4 +1,4 @@
-from sqlalchemy import and_, between, func, not_, null, or_, select
+from sqlalchemy import and_, between, case, func, not_, null, or_, select
 
 from db import Session
 from models import Club, Student, StudentClazz, StudentClub
@@ -12,8 +12,7 @@ def test_logical_groping():
         stmt = select(func.count(Student.id)).where(
             and_(Student.id == 1, or_(Student.id == 2, Student.id == 3))
         )
-        result = session.execute(stmt)
-        count = result.scalar()
+        count = session.scalar(stmt)
         print(f"### count[{count}]")
 
 
@@ -27,8 +26,7 @@ def test_and():
         stmt = select(func.count(Student.id)).where(
             Student.id == 2, Student.name.ilike("s%")
         )
-        result = session.execute(stmt)
-        count = result.scalar()
+        count = session.scalar(stmt)
         print(f"### count[{count}]")
 
 
@@ -40,28 +38,30 @@ def test_or():
         stmt = select(func.count(Student.id)).where(
             or_(Student.name.ilike("%山田%"), Student.name.ilike("%佐藤%"))
         )
-        result = session.execute(stmt)
-        count = result.scalar()
+        count = session.scalar(stmt)
         print(f"### count[{count}]")
 
 
 def test_not():
     """クラス ID:1 に所属している人数と所属していない人数を出力する
 
-    ref: https://docs.sqlalchemy.org/en/20/core/sqlelement.html#sqlalchemy.sql.expression.or_
+    ref: https://docs.sqlalchemy.org/en/20/core/sqlelement.html#sqlalchemy.sql.expression.not_
+    ref: https://docs.sqlalchemy.org/en/20/core/sqlelement.html#sqlalchemy.sql.expression.case
+
+    NOTE: MySQL は `count(*) FILTER (WHERE ...)` に対応していないため、
+          `count(case(...))` で条件ごとの件数を1回のクエリでまとめて取得する
+    NOTE: 2つのクエリを `asyncio.gather` で並列に発行する方法もあるが、1つの AsyncSession(1接続)では
+          クエリを同時に発行できないため、クエリごとに AsyncSession と async 対応のドライバが必要となる
+          ref: https://docs.sqlalchemy.org/en/20/orm/extensions/asyncio.html#using-asyncsession-with-concurrent-tasks
     """  # noqa
     with Session() as session:
-        member_count = session.execute(
-            select(func.count(StudentClazz.student_id)).where(
-                StudentClazz.class_id == 1
-            )
-        ).scalar()
-
-        non_member_count = session.execute(
-            select(func.count(StudentClazz.student_id)).where(
-                not_(StudentClazz.class_id == 1)
-            )
-        ).scalar()
+        stmt = select(
+            func.count(case((StudentClazz.class_id == 1, StudentClazz.student_id))),
+            func.count(
+                case((not_(StudentClazz.class_id == 1), StudentClazz.student_id))
+            ),
+        )
+        member_count, non_member_count = session.execute(stmt).one()
 
         print(f"### member_count[{member_count}] non_member_count[{non_member_count}]")
 
@@ -76,8 +76,7 @@ def test_in():
         stmt = select(func.count(StudentClazz.student_id)).where(
             StudentClazz.class_id.in_([1, 2, 3])
         )
-        result = session.execute(stmt)
-        count = result.scalar()
+        count = session.scalar(stmt)
         print(f"### count[{count}]")
 
 
@@ -92,8 +91,7 @@ def test_like():
     """  # noqa
     with Session() as session:
         stmt = select(func.count(Student.id)).where(Student.name.like("%佐藤%"))
-        result = session.execute(stmt)
-        count = result.scalar()
+        count = session.scalar(stmt)
         print(f"### count[{count}]")
 
 
@@ -105,11 +103,44 @@ def test_between():
     with Session() as session:
         stmt = select(func.count(Student.id)).where(between(Student.id, 1, 5))
         # ALT: stmt = select(func.count(Student.id)).where(Student.id.between(1, 5))
-        result = session.execute(stmt)
-        count = result.scalar()
+        count = session.scalar(stmt)
         print(f"### count[{count}]")
 
 
+def test_multiple_counts_in_one_query():
+    """test_and, test_or, test_like, test_between の件数を1回のクエリでまとめて取得する
+
+    条件ごとにクエリを発行するとテーブルをその回数分スキャンするため、
+    `count(case(...))` で条件ごとに集計して1回のスキャンで済ませる。
+
+    ref: https://docs.sqlalchemy.org/en/20/core/sqlelement.html#sqlalchemy.sql.expression.case
+    ref: test_not
+    """  # noqa
+    with Session() as session:
+        stmt = select(
+            func.count(
+                case((and_(Student.id == 2, Student.name.ilike("s%")), Student.id))
+            ),
+            func.count(
+                case(
+                    (
+                        or_(Student.name.ilike("%山田%"), Student.name.ilike("%佐藤%")),
+                        Student.id,
+                    )
+                )
+            ),
+            func.count(case((Student.name.like("%佐藤%"), Student.id))),
+            func.count(case((between(Student.id, 1, 5), Student.id))),
+        )
+        and_count, or_count, like_count, between_count = session.execute(stmt).one()
+        print(
+            f"### and_count[{and_count}]"
+            f" or_count[{or_count}]"
+            f" like_count[{like_count}]"
+            f" between_count[{between_count}]"
+        )
+
+
 def test_exists():
     """部活に所属している生徒の数を出力する
 
@@ -120,8 +151,7 @@ def test_exists():
         stmt = select(func.count(Student.id)).where(
             (select(1).where(Student.id == StudentClub.student_id)).exists()
         )
-        result = session.execute(stmt)
-        count = result.scalar()
+        count = session.scalar(stmt)
         print(f"### count[{count}]")
 
 
@@ -143,8 +173,10 @@ def test_subquery():
     ref: https://docs.sqlalchemy.org/en/20/orm/queryguide/select.html#selecting-entities-from-subqueries
     """  # noqa
     with Session() as session:
-        stmt = select(Club).where(Club.teacher_id == null())
-        result = session.execute(stmt)
-        clubs = result.all()
-        for (club,) in clubs:
+        stmt = (
+            select(Club)
+            .where(Club.teacher_id == null())
+            .execution_options(yield_per=500)
+        )
+        for club in session.scalars(stmt):
             print(f"### club.id[{club.id}] club.name[{club.name}]")
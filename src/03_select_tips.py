@@ -1,11 +1,15 @@
 import pytest
 from sqlalchemy import case, distinct, func, select
 from sqlalchemy.exc import MultipleResultsFound, NoResultFound
-from sqlalchemy.orm import aliased
+from sqlalchemy.orm import aliased, lazyload
 
 from db import Session
 from models import Clazz, Student, StudentClazz, StudentClub
 
+# NOTE: Student.clazz はモデルで `lazy="joined"` のため、select(Student) は student_clazz も join する  # noqa
+#       このモジュールの検証では clazz を使わないため `lazyload(Student.clazz)` で join を抑止する
+#       ref: models.py::Student
+
 
 def test_basic_usage():
     """select の基本
@@ -142,11 +146,14 @@ def test_orderby():
     ref: https://docs.sqlalchemy.org/en/20/core/selectable.html#sqlalchemy.sql.expression.Select.order_by
     """  # noqa
     with Session() as session:
-        stmt = select(Student).order_by(Student.id.desc())
+        stmt = (
+            select(Student.id, Student.name)
+            .order_by(Student.id.desc())
+            .execution_options(yield_per=500)
+        )
         result = session.execute(stmt)
-        students = result.scalars().all()
-        for student in students:
-            print(f"### student id[{student.id}] name[{student.name}]")
+        for id, name in result:
+            print(f"### student id[{id}] name[{name}]")
 
 
 def test_limit_offset():
@@ -156,7 +163,7 @@ def test_limit_offset():
     ref: https://docs.sqlalchemy.org/en/20/core/selectable.html#sqlalchemy.sql.expression.GenerativeSelect.offset
     """  # noqa
     with Session() as session:
-        stmt = select(Student).limit(3).offset(10)
+        stmt = select(Student).options(lazyload(Student.clazz)).limit(3).offset(10)
         result = session.execute(stmt)
         students = result.scalars().all()
         for student in students:
@@ -180,19 +187,19 @@ def test_count_with_group_by():
     ref: https://docs.sqlalchemy.org/en/20/core/selectable.html#sqlalchemy.sql.expression.Select.group_by
     """  # noqa
     with Session() as session:
+        # NOTE: 出力するのは id と name のみのため Clazz のエンティティではなくカラムを select する
         stmt = (
-            select(Clazz, func.count(StudentClazz.class_id).label("student_num"))
+            select(
+                Clazz.id,
+                Clazz.name,
+                func.count(StudentClazz.class_id).label("student_num"),
+            )
             .join(StudentClazz.clazz)
-            .group_by(StudentClazz.class_id)
+            .group_by(Clazz.id, Clazz.name)
         )
         result = session.execute(stmt)
-        classes = result.all()
-        for clazz, student_num in classes:
-            print(
-                f"### clazz.id[{clazz.id}]"
-                f" clazz.name[{clazz.name}]"
-                f" student_num[{student_num}]"
-            )
+        for id, name, student_num in result:
+            print(f"### clazz.id[{id}] clazz.name[{name}] student_num[{student_num}]")
 
 
 def test_count_with_group_by_and_having():
@@ -227,21 +234,28 @@ def test_inner_join():
     ref: https://docs.sqlalchemy.org/en/20/tutorial/data_select.html#tutorial-select-join
     ref: https://docs.sqlalchemy.org/en/20/core/selectable.html#sqlalchemy.sql.expression.Select.join
     ref: https://docs.sqlalchemy.org/en/20/orm/queryguide/select.html#joins
+    ref: https://docs.sqlalchemy.org/en/20/tutorial/data_select.html#using-window-functions
+
+    NOTE: 件数は `count(*) over()` で各行に付与するため、全行をリストに展開して len を取る必要はない
     """  # noqa
     with Session() as session:
         # NOTE: inner join なので club に所属していない生徒は除外する
-        stmt = select(Student.id, Student.name, StudentClub.club_id).join(
-            StudentClub, StudentClub.student_id == Student.id
-        )
+        stmt = select(
+            Student.id,
+            Student.name,
+            StudentClub.club_id,
+            func.count().over().label("total"),
+        ).join(StudentClub, StudentClub.student_id == Student.id)
         result = session.execute(stmt)
-        students = result.all()
-        for student in students:
+        total = 0
+        for student in result:
             print(
                 f"### student.id[{student.id}]"
                 f" student.name[{student.name}]"
                 f" student.club_id[{student.club_id}]"
             )
-        print(f"### len(student)[{len(students)}]")
+            total = student.total
+        print(f"### total[{total}]")
 
 
 def test_outer_join():
@@ -255,18 +269,22 @@ def test_outer_join():
     NOTE: `RIGHT OUTER JOIN` はないので、使う場合はテーブルの順序を逆にする。 (by tutorial の tips より)
     """  # noqa
     with Session() as session:
-        stmt = select(Student.id, Student.name, StudentClub.club_id).outerjoin(
-            StudentClub, StudentClub.student_id == Student.id
-        )
+        stmt = select(
+            Student.id,
+            Student.name,
+            StudentClub.club_id,
+            func.count().over().label("total"),
+        ).outerjoin(StudentClub, StudentClub.student_id == Student.id)
         result = session.execute(stmt)
-        students = result.all()
-        for student in students:
+        total = 0
+        for student in result:
             print(
                 f"### student.id[{student.id}]"
                 f" student.name[{student.name}]"
                 f" student.club_id[{student.club_id}]"
             )
-        print(f"### len(student)[{len(students)}]")
+            total = student.total
+        print(f"### total[{total}]")
 
 
 def test_join_with_subquery():
@@ -274,6 +292,9 @@ def test_join_with_subquery():
 
     ref: https://docs.sqlalchemy.org/en/20/tutorial/data_select.html#tutorial-subqueries-orm-aliased
     ref: https://docs.sqlalchemy.org/en/20/orm/queryguide/select.html#joining-to-subqueries
+
+    NOTE: この程度の条件であればサブクエリを使わずに直接 join した方がシンプルになる。
+          (ref: test_join_without_subquery)
     """  # noqa
     with Session() as session:
         sub_query = (
@@ -322,6 +343,32 @@ def test_join_with_subquery_and_alias():
         print(f"### len(student)[{len(students)}]")
 
 
+def test_join_without_subquery():
+    """クラス ID 1,3,5 に所属している生徒の一覧を出力する (サブクエリなし)
+
+    test_join_with_subquery, test_join_with_subquery_and_alias と同じ結果を
+    サブクエリを使わずに StudentClazz と直接 join して取得する。
+    StudentClazz は student_id が主キーのため生徒が重複することはない。
+
+    ref: https://docs.sqlalchemy.org/en/20/tutorial/data_select.html#tutorial-select-join
+    """  # noqa
+    with Session() as session:
+        stmt = (
+            select(Student.id, Student.name, StudentClazz.class_id)
+            .join(StudentClazz, StudentClazz.student_id == Student.id)
+            .where(StudentClazz.class_id.in_([1, 3, 5]))
+        )
+        result = session.execute(stmt)
+        students = result.all()
+        for id, name, class_id in students:
+            print(
+                f"### student.id[{id}]"
+                f" student.name[{name}]"
+                f" student_class.class_id[{class_id}]"
+            )
+        print(f"### len(student)[{len(students)}]")
+
+
 def test_select_with_subquery():
     """サブクエリの結果を select する
 
@@ -331,7 +378,7 @@ def test_select_with_subquery():
     with Session() as session:
         sub_query = select(Student).subquery()
         aliased_student = aliased(Student, sub_query)
-        stmt = select(aliased_student)
+        stmt = select(aliased_student).options(lazyload(aliased_student.clazz))
         result = session.execute(stmt)
         students = result.all()
         for (student,) in students:
@@ -352,8 +399,24 @@ def test_distinct():
     with Session() as session:
         stmt = select(func.count(distinct(StudentClazz.student_id)))
         # ALT: stmt = select(func.count(StudentClazz.student_id.distinct()))
-        result = session.execute(stmt)
-        count = result.scalar()
+        count = session.scalar(stmt)
+        print(f"### count[{count}]")
+
+
+def test_distinct_alt_exists():
+    """クラスに所属している生徒数を distinct の代わりに exists でカウントする
+
+    `count(distinct(...))` は重複排除のための集計が必要になるが、
+    exists であれば生徒ごとに最初の1件が見つかった時点で判定を終えられる。
+
+    ref: https://docs.sqlalchemy.org/en/20/tutorial/data_select.html#exists-subqueries
+    ref: https://docs.sqlalchemy.org/en/20/core/selectable.html#sqlalchemy.sql.expression.exists
+    """  # noqa
+    with Session() as session:
+        stmt = select(func.count(Student.id)).where(
+            (select(1).where(Student.id == StudentClazz.student_id)).exists()
+        )
+        count = session.scalar(stmt)
         print(f"### count[{count}]")
 
 
@@ -362,6 +425,8 @@ def test_case():
 
     ref: https://docs.sqlalchemy.org/en/20/core/sqlelement.html#sqlalchemy.sql.expression.case
     ref: https://docs.sqlalchemy.org/en/20/core/sqlelement.html#sqlalchemy.sql.expression.Case
+
+    NOTE: 単に性別ごとの人数を数えるだけであれば、行ごとに case を評価しない group by の方が軽い
     """  # noqa
     with Session() as session:
         stmt = select(
@@ -372,6 +437,12 @@ def test_case():
         man_count, woman_count = result.first()
         print(f"### man_count[{man_count}] woman_count[{woman_count}]")
 
+        # ALT: group by で性別ごとに集計する
+        stmt = select(Student.gender, func.count()).group_by(Student.gender)
+        counts = dict(session.execute(stmt).all())
+        man_count, woman_count = counts.get(1, 0), counts.get(2, 0)
+        print(f"### man_count[{man_count}] woman_count[{woman_count}]")
+
 
 def test_server_side_cursors():
     """結果を分割して処理する。(メモリのバッファオーバーフロー対策)
@@ -384,11 +455,13 @@ def test_server_side_cursors():
     TODO: クエリ的には１回しか呼ばれてない。 DB 側でバッファリングしてる？
     """  # noqa
     with Session() as session:
-        stmt = select(Student)
+        stmt = select(Student.id, Student.name)
         cursor = session.execute(stmt, execution_options={"yield_per": 50})
         for students in cursor.partitions():
-            for (student,) in students:
-                print(f"### student id[{student.id}] name[{student.name}]")
+            # NOTE: 1行ずつ print せずにパーティション単位でまとめて出力する
+            print(
+                "\n".join(f"### student id[{id}] name[{name}]" for id, name in students)
+            )
 
 
 def test_server_side_cursors_alt_ver2():
@@ -397,13 +470,22 @@ def test_server_side_cursors_alt_ver2():
     ref: https://docs.sqlalchemy.org/en/20/orm/queryguide/api.html#fetching-large-result-sets-with-yield-per
 
     NOTE: `yield_per` は eager ロードと互換性がないらしいので注意が必要、とのこと。
+          (一対多の joined load とは併用できない。多対一の Student.clazz も使わないので lazyload にしている)
     """  # noqa
     with Session() as session:
-        stmt = select(Student).execution_options(yield_per=50)
+        stmt = (
+            select(Student)
+            .options(lazyload(Student.clazz))
+            .execution_options(yield_per=50)
+        )
         cursor = session.scalars(stmt).partitions()
         for students in cursor:
-            for student in students:
-                print(f"### student id[{student.id}] name[{student.name}]")
+            print(
+                "\n".join(
+                    f"### student id[{student.id}] name[{student.name}]"
+                    for student in students
+                )
+            )
 
 
 def test_server_side_cursors_alt_ver3():
@@ -414,7 +496,11 @@ def test_server_side_cursors_alt_ver3():
     ref: https://docs.sqlalchemy.org/en/20/orm/queryguide/api.html#fetching-large-result-sets-with-yield-per
     """  # noqa
     with Session() as session:
-        stmt = select(Student).execution_options(yield_per=50)
+        stmt = (
+            select(Student)
+            .options(lazyload(Student.clazz))
+            .execution_options(yield_per=50)
+        )
         students = session.scalars(stmt)
         for student in students:
             print(f"### student id[{student.id}] name[{student.name}]")
@@ -10,6 +10,8 @@ from sqlalchemy.orm import (
     aliased,
     contains_eager,
     joinedload,
+    lazyload,
+    load_only,
     raiseload,
     selectinload,
 )
@@ -18,6 +20,27 @@ from sqlalchemy.orm.exc import DetachedInstanceError
 from db import Session
 from models import Clazz, Email, Student, StudentClazz
 
+# ローディング方法ごとの検証で使う select。
+# テストごとに同じステートメントを組み立てずに済むようにモジュールで1度だけ組み立てる
+# NOTE: Student.clazz はモデルで `lazy="joined"` のため、検証するローディング以外の join が混ざらないように
+#       clazz を使わない検証では `lazyload(Student.clazz)` で join を抑止する (ref: models.py::Student)
+LAZY_LOAD_STUDENTS = select(Student).options(lazyload(Student.clazz)).limit(3)
+SELECTIN_LOAD_STUDENTS = (
+    select(Student)
+    .options(selectinload(Student.emails), lazyload(Student.clazz))
+    .limit(3)
+)
+JOINED_LOAD_EMAILS = (
+    select(Email)
+    .options(joinedload(Email.student, innerjoin=False).lazyload(Student.clazz))
+    .limit(3)
+)
+JOINED_LOAD_STUDENTS = (
+    select(Student)
+    .options(joinedload(Student.emails, innerjoin=False), lazyload(Student.clazz))
+    .limit(3)
+)
+
 
 def test_basic_relationship():
     with Session() as session:
@@ -53,11 +76,12 @@ def test_basic_relationship():
         session.commit()
         # => student1 と email1 はコミットするが email2 はコミットしない
 
-        # commit するとオブジェクトをリフレッシュするため、オブジェクトの attribute にアクセスすると
-        # select クエリを発行して id を含めて再取得する
+        # Session は expire_on_commit=False のため commit してもオブジェクトは期限切れにならない。
+        # id は insert 時に採番した値を保持しているため select クエリを発行せずに参照できる
+        # (expire_on_commit=True の場合は attribute へのアクセス時に select クエリを発行して再取得する)
         print(f"### student1.id[{student1.id}]")
 
-        # emails にもアクセスできるが遅延ロードとなる(アクセス時にクエリを発行する)
+        # emails も追加した時点の内容を保持しているためクエリを発行しない
         print(f"### student1.emails[{student1.emails}]")
 
 
@@ -65,8 +89,11 @@ def test_detached_instance_error():
     """コミット後に session 外でアクセスすると DetachedInstanceError となる
 
     このため session 外でアクセスする場合には事前に session 内でアクセスしておくと良い。
+
+    NOTE: Session は expire_on_commit=False を指定しているため、
+          ここでは commit 時に期限切れにするように expire_on_commit=True で上書きしている
     """
-    with Session() as session:
+    with Session(expire_on_commit=True) as session:
         student = Student(name="name", gender=1, address="address", score=50)
         session.add(student)
         session.commit()
@@ -81,10 +108,16 @@ def test_join_by_relationship():
     ref: https://docs.sqlalchemy.org/en/20/orm/queryguide/select.html#simple-relationship-joins
 
     NOTE: join にリレーションを指定すると、自動的に外部キーで join してくれる
+    NOTE: Student.clazz はモデルで `lazy="joined"` のため、そのままだと eager ロード用に student_clazz を
+          もう一度 join してしまう。`contains_eager()` で明示的な join の結果を Student.clazz にも流用する
     TODO: 外部キーがない場合はエラーになるのか？
     """  # noqa
     with Session() as session:
-        stmt = select(Student, StudentClazz).join(Student.clazz)
+        stmt = (
+            select(Student, StudentClazz)
+            .join(Student.clazz)
+            .options(contains_eager(Student.clazz))
+        )
         result = session.execute(stmt)
         students = result.all()
         for record in students:
@@ -107,9 +140,23 @@ def test_join_by_relationship():
 def test_multi_join_by_relationship():
     """
     ref: https://docs.sqlalchemy.org/en/20/orm/queryguide/select.html#chaining-multiple-joins
+    ref: https://docs.sqlalchemy.org/en/20/orm/queryguide/columns.html#using-load-only-to-reduce-loaded-columns
+
+    NOTE: 出力に使うカラムのみを `load_only()` でロードする
+    NOTE: Student.clazz は使わないため、モデルの `lazy="joined"` による student_clazz の二重の join を
+          `lazyload()` で抑止する
     """  # noqa
     with Session() as session:
-        stmt = select(Student, Clazz).join(Student.clazz).join(StudentClazz.clazz)
+        stmt = (
+            select(Student, Clazz)
+            .join(Student.clazz)
+            .join(StudentClazz.clazz)
+            .options(
+                lazyload(Student.clazz),
+                load_only(Student.id, Student.name),
+                load_only(Clazz.id, Clazz.name),
+            )
+        )
         result = session.execute(stmt)
         students = result.all()
         for student, clazz in students:
@@ -124,15 +171,16 @@ def test_multi_join_by_relationship():
 def test_lazy_load():
     """joinやeagerロードを使わずに複数回のクエリを発行するケース
 
-    ローディングのデフォルト。
+    モデルの relationship は `lazy="raise"` または `lazy="joined"` のため遅延ロードはデフォルトではなく、
+    `lazyload()` を指定したクエリ(LAZY_LOAD_STUDENTS)でのみ遅延ロードする。
 
     ref: https://docs.sqlalchemy.org/en/20/orm/queryguide/relationships.html#lazy-loading
+    ref: test_joined_load_by_model
 
     NOTE: `student.clazz.class_id` を取得する際に select 文を毎度発行するため N+1 問題となるケース
     """  # noqa
     with Session() as session:
-        stmt = select(Student).limit(3)
-        result = session.execute(stmt)
+        result = session.execute(LAZY_LOAD_STUDENTS)
         students = result.scalars().all()
         for student in students:
             print(
@@ -142,7 +190,27 @@ def test_lazy_load():
             )
 
 
-def test_selectin_load():
+def test_joined_load_by_model(count_queries):
+    """モデルの relationship で宣言した joined load による eager ロード
+
+    `Student.clazz` は `lazy="joined"` のため、options を指定しなくても join してロードする。
+
+    ref: https://docs.sqlalchemy.org/en/20/orm/queryguide/relationships.html#configuring-loader-strategies-at-mapping-time
+    ref: models.py::Student
+    """  # noqa
+    with Session() as session:
+        for student in session.scalars(select(Student).limit(3)):
+            print(
+                f"### student.id[{student.id}]"
+                f" student.name[{student.name}]"
+                f" student.clazz.class_id[{student.clazz.class_id}]"
+            )
+
+        # リレーション先へのアクセスでクエリを発行していないこと
+        assert len(count_queries) == 1
+
+
+def test_selectin_load(count_queries):
     """リレーション先を in 句で eager ロードする
 
     次の2つの select を発行する。
@@ -159,20 +227,26 @@ def test_selectin_load():
 
     NOTE: いくつかの制約あり。
           - in 句を使うため上限制約を考慮する必要がある
+            (SQLAlchemy 側で in 句を 500 件ごとに分割して select を発行する)
           - 複合主キーについては DB 依存
+    NOTE: mysql+pymysql では yield_per はバッファリングしないサーバーサイドカーソルを使う。
+          読み込み途中のカーソルと同じコネクションで in 句の select を発行すると、pymysql は未読の行を破棄するため
+          selectin load とは併用できない (併用する場合はバッファリングするカーソルか別のコネクションが必要)
+          ref: https://docs.sqlalchemy.org/en/20/orm/queryguide/api.html#yield-per
     """  # noqa
     with Session() as session:
-        stmt = select(Student).options(selectinload(Student.emails)).limit(3)
-        result = session.execute(stmt)
-        for student in result.scalars():
+        for student in session.scalars(SELECTIN_LOAD_STUDENTS):
             print(
                 f"### student.id[{student.id}]"
                 f" student.name[{student.name}]"
                 f" student.emails[{[email.email for email in student.emails]}]"
             )
 
+        # リレーション先へのアクセスでクエリを発行していないこと
+        assert len(count_queries) == 2
+
 
-def test_joined_load_with_many_to_one_relationship():
+def test_joined_load_with_many_to_one_relationship(count_queries):
     """多対一のリレーションに対する joined load による eager ロード
 
     join によるロードのためクエリを1回発行する。
@@ -187,10 +261,7 @@ def test_joined_load_with_many_to_one_relationship():
     ref: https://docs.sqlalchemy.org/en/20/orm/queryguide/relationships.html#sqlalchemy.orm.joinedload
     """  # noqa
     with Session() as session:
-        stmt = (
-            select(Email).options(joinedload(Email.student, innerjoin=False)).limit(3)
-        )
-        result = session.execute(stmt)
+        result = session.execute(JOINED_LOAD_EMAILS)
         for email in result.scalars().all():
             print(
                 f"### student.id[{email.student.id}]"
@@ -198,6 +269,9 @@ def test_joined_load_with_many_to_one_relationship():
                 f" student.emails[{email.email}]"
             )
 
+        # リレーション先へのアクセスでクエリを発行していないこと
+        assert len(count_queries) == 1
+
 
 def test_joined_load_with_one_to_many_relationship():
     """一対多のリレーションに対する joined load による eager ロード
@@ -209,14 +283,12 @@ def test_joined_load_with_one_to_many_relationship():
     NOTE: 一対多の関係を joined load する場合は `unique()` する必要がある。 (by queryguide の tips より)
           理由は join で結合するため一側が複数行となるため。
           `unique()` がないと `sqlalchemy.exc.InvalidRequestError` の例外となる
+    NOTE: 一側の行が多側の件数分だけ重複して返るため、取得する行数は 生徒数 x メールアドレス数 となる。
+          一対多では selectin load を使うと 生徒数 + メールアドレス数 の行数で済み、`unique()` も不要となる。
+          (ref: test_selectin_load)
     """  # noqa
     with Session() as session:
-        stmt = (
-            select(Student)
-            .options(joinedload(Student.emails, innerjoin=False))
-            .limit(3)
-        )
-        result = session.execute(stmt)
+        result = session.execute(JOINED_LOAD_STUDENTS)
         for student in result.scalars().unique().all():
             print(
                 f"### student.id[{student.id}]"
@@ -225,13 +297,13 @@ def test_joined_load_with_one_to_many_relationship():
             )
 
         # `unique()` がない場合
-        result = session.execute(stmt)
+        result = session.execute(JOINED_LOAD_STUDENTS)
         with pytest.raises(InvalidRequestError) as e:
             result.scalars().all()
         print(f"### ***ERROR*** [{e}]")
 
 
-def test_contains_eager():
+def test_contains_eager(count_queries):
     """join した結果を流用した eager ロード
 
     ref: https://docs.sqlalchemy.org/en/20/tutorial/orm_related_objects.html#explicit-join-eager-load
@@ -245,7 +317,7 @@ def test_contains_eager():
         stmt = (
             select(Email)
             .join(Email.student)
-            .options(contains_eager(Email.student))
+            .options(contains_eager(Email.student).lazyload(Student.clazz))
             .limit(3)
         )
         result = session.execute(stmt)
@@ -256,6 +328,9 @@ def test_contains_eager():
                 f" student.emails[{email.email}]"
             )
 
+        # リレーション先へのアクセスでクエリを発行していないこと
+        assert len(count_queries) == 1
+
 
 def test_raiseload():
     """N+1 問題は絶対にゆるさんぞい
@@ -284,12 +359,19 @@ def test_raiseload():
 
 
 def test_raiseload_特定の遅延ロード禁止を設定する():
+    """
+    NOTE: モデルでは `lazy="raise"` で遅延ロードを禁止しているため、
+          OK とするリレーションには `lazyload()` で遅延ロードを指定している
+    """  # noqa
     with Session() as session:
         # Student -> StudentClazz -> Clazz は OK
         # Student -> Email は OUT
         stmt = (
             select(Student)
-            .options(joinedload(Student.clazz), Load(Student).raiseload("*"))
+            .options(
+                joinedload(Student.clazz).lazyload(StudentClazz.clazz),
+                Load(Student).raiseload("*"),
+            )
             .limit(1)
         )
         result = session.execute(stmt)
@@ -304,7 +386,9 @@ def test_raiseload_特定の遅延ロード禁止を設定する():
         # Student -> StudentClazz -> Clazz は OUT
         # Student -> Email は OK
         stmt = (
-            select(Student).options(joinedload(Student.clazz).raiseload("*")).limit(1)
+            select(Student)
+            .options(joinedload(Student.clazz).raiseload("*"), lazyload(Student.emails))
+            .limit(1)
         )
         result = session.execute(stmt)
         student = result.scalars().first()
@@ -375,7 +459,8 @@ def test_aliasを使ったjoinとcontains_eagerロード():
             .outerjoin(Student.emails.of_type(eamil_alias))
             .options(
                 contains_eager(Email.student).options(
-                    contains_eager(Student.emails.of_type(eamil_alias))
+                    contains_eager(Student.emails.of_type(eamil_alias)),
+                    lazyload(Student.clazz),
                 )
             )
         )
@@ -5,16 +5,32 @@ import pytest
 from sqlalchemy import bindparam, select
 from sqlalchemy.dialects.mysql import insert
 from sqlalchemy.exc import NoResultFound
+from sqlalchemy.orm import lazyload
 from sqlalchemy.orm.exc import StaleDataError
 
-from db import Session
+from db import ScopedSession, Session
 from models import Student
 
+# 悲観的ロックの検証で使う select for update。
+# スレッドごとにステートメントを組み立てずに済むように bind パラメータで生徒 ID を受け取る
+# NOTE: Student.clazz はモデルで `lazy="joined"` のため、そのままだと student_clazz も join して
+#       ロックしてしまう。`lazyload()` で join せずに students の行のみをロックする
+FOR_UPDATE_BY_ID = (
+    select(Student)
+    .where(Student.id == bindparam("sid"))
+    .options(lazyload(Student.clazz))
+    .with_for_update()
+)
+
 
 def test_upsert():
     """
     ref: https://docs.sqlalchemy.org/en/20/orm/queryguide/dml.html#orm-upsert-statements
     ref: https://docs.sqlalchemy.org/en/20/dialects/mysql.html#insert-on-duplicate-key-update-upsert (ONLY MySQL)
+
+    NOTE: `returning()` を使うと upsert 後の値を select せずに取得できるが、
+          MySQL は INSERT ... RETURNING に対応していない(MariaDB は 10.5 以降で対応)。
+          MySQL で upsert 後の値が必要な場合は select を発行する
     """  # noqa
     with Session() as session:
         stmt = (
@@ -22,6 +38,8 @@ def test_upsert():
             .values(id=1, name="name", gender=1, address="address", score=50)
             .on_duplicate_key_update(
                 name="name name name",
+                # 楽観的ロックの version_id (ref: models.py::Student)
+                version_id=Student.version_id + 1,
             )
         )
         session.execute(stmt)
@@ -29,6 +47,12 @@ def test_upsert():
 
 
 def test_bulk_insert():
+    """
+    ref: https://docs.sqlalchemy.org/en/20/orm/queryguide/dml.html#orm-bulk-insert-statements
+    ref: db.py::engine (pymysql の executemany)
+
+    NOTE: `execute()` の第2引数に dict の配列を渡すと executemany となる
+    """  # noqa
     with Session() as session:
         students = [
             {
@@ -50,15 +74,40 @@ def test_bulk_insert():
                 "score": 99,
             },
         ]
-        stmt = insert(Student).values(
-            name=bindparam("name"),
-            gender=bindparam("gender"),
-            address=bindparam("address"),
-        )
-        session.execute(stmt, students)
+        session.execute(insert(Student), students)
         session.commit()
 
 
+def test_compiled_cache():
+    """コンパイル済み SQL のキャッシュ
+
+    同じ構造のステートメントは SQL のコンパイル結果をキャッシュして再利用する。
+    キャッシュは Engine が保持している(query_cache_size)が、
+    execution_options の compiled_cache で任意の dict を指定することもできる。
+
+    ref: https://docs.sqlalchemy.org/en/20/core/connections.html#sql-compilation-caching
+    ref: https://docs.sqlalchemy.org/en/20/core/connections.html#sqlalchemy.engine.Connection.execution_options.params.compiled_cache
+
+    NOTE: bind パラメータの値はキャッシュキーに含まれないため、値が異なっても同じキャッシュを使う
+    """  # noqa
+    compiled_cache = {}
+    stmt = (
+        select(Student)
+        .where(Student.id == bindparam("id"))
+        .options(lazyload(Student.clazz))
+    )
+    with Session() as session:
+        for student_id in [1, 2, 3]:
+            student = session.scalar(
+                stmt,
+                {"id": student_id},
+                execution_options={"compiled_cache": compiled_cache},
+            )
+            print(f"### student.id[{student.id}] student.name[{student.name}]")
+    # => 3回実行しているがキャッシュは1件
+    print(f"### len(compiled_cache)[{len(compiled_cache)}]")
+
+
 def test_session_明示的なbegin_commit_rollback():
     """
     ref: https://docs.sqlalchemy.org/en/20/orm/session_basics.html#framing-out-a-begin-commit-rollback-block
@@ -77,6 +126,10 @@ def test_session_明示的なbegin_commit_rollback():
 def test_session_自動commit():
     """
     ref: https://docs.sqlalchemy.org/en/20/orm/session_basics.html#framing-out-a-begin-commit-rollback-block
+
+    NOTE: PostgreSQL(psycopg3) には結果を待たずに複数のクエリを連続して送信する pipeline mode があるが、
+          pymysql(MySQL) にはないため、往復回数を減らすには executemany などでクエリ自体をまとめる
+          ref: https://www.psycopg.org/psycopg3/docs/advanced/pipeline.html
     """  # noqa
     with Session() as session:
         # ここは session scope (?)
@@ -95,14 +148,19 @@ def test_pessimistic_lock():
 
     ref: https://blog.amedama.jp/entry/2015/09/28/065805
     ref: https://qiita.com/t_okkan/items/ce9d145750cd07e70606
+    ref: https://docs.sqlalchemy.org/en/20/orm/contextual.html
+
+    NOTE: ロックはコネクション(トランザクション)単位のため、スレッドごとに別のコネクションが必要となる。
+          savepoint のように1つのコネクションを共有すると、後続のスレッドが待たされずロックの検証にならない。
+          また DBAPI のコネクションはスレッドセーフではないため、スレッド間で共有できない
     """  # noqa
 
     def _update(thread_key, student_id, score, wait):
-        with Session() as session:
+        # スレッドごとの session を scoped_session から取得する
+        session = ScopedSession()
+        try:
             # 悲観的ロックの場合は後続が select の発行で待ちとなる
-            student = session.scalar(
-                select(Student).where(Student.id == student_id).with_for_update()
-            )
+            student = session.scalar(FOR_UPDATE_BY_ID, {"sid": student_id})
             print(f"### [{thread_key}] student.score[{student.score}]")
 
             print(f"### [{thread_key}] Sleep[{wait}]")
@@ -115,14 +173,19 @@ def test_pessimistic_lock():
             session.commit()
 
             print(f"### [{thread_key}] Finish! student.score[{student_score}]")
+        finally:
+            ScopedSession.remove()
 
     t1 = threading.Thread(target=_update, args=("t1", 1, 1, 1))
     t2 = threading.Thread(target=_update, args=("t2", 1, 1, 1))
     # もちろんロックしていないユーザーは待たされない
     t3 = threading.Thread(target=_update, args=("t3", 2, 1, 1))
-    t1.start()
-    t2.start()
-    t3.start()
+    threads = [t1, t2, t3]
+    for t in threads:
+        t.start()
+    # 後続のテストにコネクションを持ち越さないように、スレッドの終了を待ってプールへ返却させる
+    for t in threads:
+        t.join()
 
 
 def test_pessimistic_lock_to_table():
@@ -146,15 +209,16 @@ def test_pessimistic_lock_to_table():
         with Session() as session:
             # 後発にしたいので 0.1s スリープ
             time.sleep(0.1)
-            student = session.scalar(
-                select(Student).where(Student.id == student_id).with_for_update()
-            )
+            student = session.scalar(FOR_UPDATE_BY_ID, {"sid": student_id})
             _update(thread_key, session, student, score, wait)
 
     def _update_with_table_lock(thread_key, score, wait):
         with Session() as session:
             student = session.scalar(
-                select(Student).order_by(Student.id.asc()).with_for_update()
+                select(Student)
+                .order_by(Student.id.asc())
+                .options(lazyload(Student.clazz))
+                .with_for_update()
             )
             _update(thread_key, session, student, score, wait)
 
@@ -162,9 +226,11 @@ def test_pessimistic_lock_to_table():
     t2 = threading.Thread(target=_update_with_table_lock, args=("t2", 1, 1))
     # テーブルロックの場合は t3 も待ちとなる
     t3 = threading.Thread(target=_update_with_row_lock, args=("t3", 2, 1, 1))
-    t1.start()
-    t2.start()
-    t3.start()
+    threads = [t1, t2, t3]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
 
 
 def test_optimistic_lock():
@@ -178,7 +244,11 @@ def test_optimistic_lock():
 
     def _update(thread_key, student_id, score, wait):
         with Session() as session:
-            student = session.scalar(select(Student).where(Student.id == student_id))
+            student = session.scalar(
+                select(Student)
+                .where(Student.id == student_id)
+                .options(lazyload(Student.clazz))
+            )
 
             print(f"### [{thread_key}] Sleep[{wait}]")
             time.sleep(wait)
@@ -193,12 +263,15 @@ def test_optimistic_lock():
 
             print(f"### [{thread_key}] Finish!")
 
-    # t1 が先行して UPDATE するため、後続の t2 は version_id_col で監視している updated_at が
+    # t1 が先行して UPDATE するため、後続の t2 は version_id_col で監視している version_id が
     # アンマッチとなり StaleDataError の例外が発生する。
     t1 = threading.Thread(target=_update, args=("t1", 1, 1, 0))
     t2 = threading.Thread(target=_update, args=("t2", 1, 1, 0.5))
-    t1.start()
-    t2.start()
+    threads = [t1, t2]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
 
 
 def test_テストスイート向けのsavepointを利用したコミットのロールバック():
@@ -224,6 +297,8 @@ def test_テストスイート向けのsavepointを利用したコミットの
     with Session() as session:
         with pytest.raises(NoResultFound) as e:
             student = session.execute(
-                select(Student).where(Student.id == student_id)
+                select(Student)
+                .where(Student.id == student_id)
+                .options(lazyload(Student.clazz))
             ).one()
         print(f"### ***ERROR*** [{e}]")
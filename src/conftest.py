@@ -0,0 +1,29 @@
+"""pytest の fixture
+
+ref: https://docs.pytest.org/en/7.4.x/how-to/fixtures.html
+"""  # noqa
+
+import pytest
+from sqlalchemy import event
+
+from db import engine
+
+
+@pytest.fixture
+def count_queries():
+    """テスト中に発行したクエリを記録する
+
+    N+1 問題などで想定外のクエリを発行していないか、クエリの数を assert して確認する。
+
+    ref: https://docs.sqlalchemy.org/en/20/core/events.html#sqlalchemy.events.ConnectionEvents.before_cursor_execute
+    """  # noqa
+    queries = []
+
+    def _before_cursor_execute(
+        conn, cursor, statement, parameters, context, executemany
+    ):
+        queries.append(statement)
+
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    yield queries
+    event.remove(engine, "before_cursor_execute", _before_cursor_execute)
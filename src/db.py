@@ -7,13 +7,16 @@ ref: https://docs.sqlalchemy.org/en/20/orm/session_basics.html#using-a-sessionma
 ref: https://docs.sqlalchemy.org/en/20/orm/session_basics.html#when-do-i-construct-a-session-when-do-i-commit-it-and-when-do-i-close-it
 """  # noqa
 
+import logging
 import os
 
 from sqlalchemy import URL, create_engine, text
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import scoped_session, sessionmaker
 
 url = URL.create(
-    drivername="mysql+pymysql",
+    # NOTE: C 拡張の mysqlclient を使う場合は DB_DRIVERNAME に mysql+mysqldb を指定する
+    #       ref: https://docs.sqlalchemy.org/en/20/dialects/mysql.html#module-sqlalchemy.dialects.mysql.mysqldb  # noqa
+    drivername=os.getenv("DB_DRIVERNAME", "mysql+pymysql"),
     username=os.getenv("DB_USERNAME", "testuser"),
     password=os.getenv("DB_PASSWORD", "testpassword"),
     host=os.getenv("DB_HOST", "localhost"),
@@ -21,8 +24,43 @@ url = URL.create(
     port=int(os.getenv("DB_PORT", "3306")),
 )
 print(f"### db conn url[{url}]")
-engine = create_engine(url, echo=True)
-Session = sessionmaker(bind=engine)
+# NOTE: executemany_mode は psycopg2 (PostgreSQL) 用のオプションのため mysql+pymysql では指定できない。
+#       pymysql は executemany の際に `INSERT ... VALUES` を複数行の VALUES にまとめて送信する
+#       ref: https://docs.sqlalchemy.org/en/20/dialects/postgresql.html#psycopg2-fast-execution-helpers  # noqa
+#       ref: https://pymysql.readthedocs.io/en/latest/modules/cursors.html#pymysql.cursors.Cursor.executemany  # noqa
+# NOTE: insertmanyvalues_page_size は RETURNING 付きの INSERT で SQLAlchemy が VALUES をまとめる件数。
+#       mysql+pymysql は RETURNING に対応しておらず insertmanyvalues を使わないため指定していない
+#       ref: https://docs.sqlalchemy.org/en/20/core/connections.html#engine-insertmanyvalues  # noqa
+# NOTE: query_cache_size はコンパイル済み SQL のキャッシュ件数(デフォルトは 500)。
+#       `Student.id == 1` のようなリテラル値も bind パラメータとしてキャッシュキーから除外されるため、
+#       値が異なるだけのクエリは同じキャッシュを使う
+#       ref: https://docs.sqlalchemy.org/en/20/core/connections.html#sql-compilation-caching  # noqa
+# NOTE: echo によるログ出力はクエリごとに SQL やパラメータを整形するため、環境変数 DB_ECHO=1 の場合のみ有効にする
+# NOTE: echo が無効な場合に root logger の設定(pytest の --log-level など)を引き継いで
+#       SQL のログを出力しないように WARNING にしておく。echo=True の場合は echo の設定が優先される
+logging.getLogger("sqlalchemy.engine").setLevel(logging.WARNING)
+engine = create_engine(
+    url,
+    echo=os.getenv("DB_ECHO") == "1",
+    query_cache_size=1200,
+    # NOTE: スレッドで同時に接続する検証(悲観的ロックなど)があるため、コネクションプールの上限を明示しておく
+    #       ref: https://docs.sqlalchemy.org/en/20/core/pooling.html#sqlalchemy.pool.QueuePool  # noqa
+    pool_size=8,
+    max_overflow=4,
+    # NOTE: プールから取り出す際に疎通確認し、切断済みのコネクションを使ってエラーにならないようにする。
+    #       また MySQL の wait_timeout で切断される前にコネクションを作り直す
+    #       ref: https://docs.sqlalchemy.org/en/20/core/pooling.html#disconnect-handling-pessimistic  # noqa
+    #       ref: https://docs.sqlalchemy.org/en/20/core/pooling.html#setting-pool-recycle  # noqa
+    pool_pre_ping=True,
+    pool_recycle=3600,
+)
+# NOTE: expire_on_commit=False により commit 後もオブジェクトの attribute を期限切れにしない。
+#       commit 後に attribute にアクセスしても再取得の select を発行しない
+#       ref: https://docs.sqlalchemy.org/en/20/orm/session_api.html#sqlalchemy.orm.Session.params.expire_on_commit  # noqa
+Session = sessionmaker(bind=engine, expire_on_commit=False)
+# NOTE: スレッドごとに同じ session を返す。使い終わったら `ScopedSession.remove()` で破棄する
+#       ref: https://docs.sqlalchemy.org/en/20/orm/contextual.html
+ScopedSession = scoped_session(Session)
 
 
 def test_db_connecting():
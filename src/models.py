@@ -4,7 +4,7 @@ ref: https://docs.sqlalchemy.org/en/20/tutorial/orm_related_objects.html
 """  # noqa
 from datetime import datetime
 
-from sqlalchemy import INTEGER, ForeignKey, String, func
+from sqlalchemy import INTEGER, ForeignKey, Index, String, UniqueConstraint, func
 from sqlalchemy.dialects.mysql import TIMESTAMP
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 
@@ -24,6 +24,11 @@ class Student(Base):
     ref: https://docs.sqlalchemy.org/en/20/orm/collection_api.html#customizing-collection-access
 
     NOTE: `relationship()` の `back_populates` では、リレーション先に存在する attribute を指定する。存在しない場合はエラーとなる
+    NOTE: 意図しない遅延ロード(N+1 問題)を防ぐため、リレーションは `lazy="raise"` として遅延ロードを禁止している。
+          リレーション先が必要な場合はクエリの options で eager ロード(または `lazyload()`)を指定する
+          ref: https://docs.sqlalchemy.org/en/20/orm/queryguide/relationships.html#preventing-unwanted-lazy-loads-using-raiseload
+    NOTE: ただし one-to-one の clazz はほぼ必ず参照し、join しても行数が増えないため `lazy="joined"` で常に eager ロードする
+          ref: https://docs.sqlalchemy.org/en/20/orm/queryguide/relationships.html#configuring-loader-strategies-at-mapping-time
     """  # noqa
 
     __tablename__ = "students"
@@ -37,34 +42,49 @@ class Student(Base):
     updated_at: Mapped[datetime] = mapped_column(
         TIMESTAMP, nullable=False, server_default=func.now(), onupdate=func.now()
     )
+    version_id: Mapped[int] = mapped_column(INTEGER, nullable=False, server_default="0")
 
-    emails: Mapped[list["Email"]] = relationship(back_populates="student")
+    emails: Mapped[list["Email"]] = relationship(back_populates="student", lazy="raise")
     # Classic Style: emails = relationship("Email", collection_class=set, back_populates="student")  # noqa
 
-    clazz: Mapped["StudentClazz"] = relationship()
+    # NOTE: クラスに所属していない生徒も取得できるように LEFT OUTER JOIN とする
+    clazz: Mapped["StudentClazz"] = relationship(lazy="joined", innerjoin=False)
     # NOTE: Imperative な場合に one-to-one 制約を付与する場合は
     #       親側の relationship に `uselist=False` を付与する
     # Classic Style: clazz = relationship("Clazz", uselist=False, back_populates="student")  # noqa
 
-    # 楽観的ロックの検証用。システム的に updated_at を更新するため version_id_generator は False となる
-    __mapper_args__ = {"version_id_col": updated_at, "version_id_generator": False}
+    # 楽観的ロックの検証用。version_id は ORM で更新するたびに SQLAlchemy がカウントアップする
+    # NOTE: カウントアップするのは ORM の flush による更新のみ。`update(Student)` や upsert などの
+    #       ステートメントで更新する場合は `version_id=Student.version_id + 1` を明示的に指定する
+    # NOTE: TIMESTAMP の updated_at を使うと、同じ時刻に更新された場合に競合を検知できない
+    __mapper_args__ = {"version_id_col": version_id}
 
 
 class Email(Base):
+    """
+    ref: https://docs.sqlalchemy.org/en/20/orm/declarative_tables.html#declarative-table-configuration
+    ref: https://docs.sqlalchemy.org/en/20/core/constraints.html#sqlalchemy.schema.UniqueConstraint
+
+    NOTE: (email, student_id) の複合キーではなく INTEGER の id を主キーとし、
+          (email, student_id) はユニーク制約とする。主キーが小さいとインデックスや join のキーも小さくなる
+    """  # noqa
+
     __tablename__ = "emails"
+    __table_args__ = (
+        UniqueConstraint("email", "student_id"),
+        # 生徒からメールアドレスを引く(selectinload の in 句など)ためのインデックス
+        Index("ix_email_student", "student_id"),
+    )
 
+    id: Mapped[int] = mapped_column(INTEGER, primary_key=True)
     # TODO: mail 用の型とかある？
     email: Mapped[str] = mapped_column(String(255), nullable=False)
     student_id: Mapped[int] = mapped_column(
         INTEGER, ForeignKey("students.id", ondelete="CASCADE")
     )
 
-    # NOTE: 複合主キー
-    # ref: https://docs.sqlalchemy.org/en/20/orm/declarative_config.html#mapper-configuration-options-with-declarative  # noqa
-    __mapper_args__ = {"primary_key": [email, student_id]}
-
     # 検証用に back_populates は指定していない
-    student: Mapped["Student"] = relationship()
+    student: Mapped["Student"] = relationship(lazy="raise")
 
 
 class Teacher(Base):
@@ -96,9 +116,12 @@ class StudentClazz(Base):
 
     ref: https://docs.sqlalchemy.org/en/20/orm/declarative_tables.html#declarative-table-configuration
     ref: https://docs.sqlalchemy.org/en/20/core/constraints.html#sqlalchemy.schema.UniqueConstraint
+    ref: https://docs.sqlalchemy.org/en/20/core/constraints.html#sqlalchemy.schema.Index
     """  # noqa
 
     __tablename__ = "student_clazz"
+    # クラスから所属する生徒を引くためのインデックス。student_id も含めてインデックスのみで完結させる
+    __table_args__ = (Index("ix_sc_class_student", "class_id", "student_id"),)
 
     student_id: Mapped[int] = mapped_column(
         INTEGER, ForeignKey("students.id", ondelete="CASCADE"), primary_key=True
@@ -107,13 +130,15 @@ class StudentClazz(Base):
         INTEGER, ForeignKey("classes.id", ondelete="RESTRICT")
     )
 
-    student: Mapped["Student"] = relationship(back_populates="clazz")
-    clazz: Mapped["Clazz"] = relationship()
+    student: Mapped["Student"] = relationship(back_populates="clazz", lazy="raise")
+    clazz: Mapped["Clazz"] = relationship(lazy="raise")
 
 
 class TeacherClazz(Base):
     __tablename__ = "teacher_clazz"
+    __table_args__ = (UniqueConstraint("teacher_id", "class_id"),)
 
+    id: Mapped[int] = mapped_column(INTEGER, primary_key=True)
     teacher_id: Mapped[int] = mapped_column(
         INTEGER, ForeignKey("teachers.id", ondelete="RESTRICT")
     )
@@ -121,17 +146,15 @@ class TeacherClazz(Base):
         INTEGER, ForeignKey("classes.id", ondelete="CASCADE")
     )
 
-    __mapper_args__ = {"primary_key": [teacher_id, class_id]}
-
 
 class StudentClub(Base):
     __tablename__ = "student_club"
+    __table_args__ = (UniqueConstraint("student_id", "club_id"),)
 
+    id: Mapped[int] = mapped_column(INTEGER, primary_key=True)
     student_id: Mapped[int] = mapped_column(
         INTEGER, ForeignKey("students.id", ondelete="CASCADE")
     )
     club_id: Mapped[int] = mapped_column(
         INTEGER, ForeignKey("clubs.id", ondelete="RESTRICT")
     )
-
-    __mapper_args__ = {"primary_key": [student_id, club_id]}
@@ -1,9 +1,10 @@
 """検証用データ投入用 seeder"""
 
+import os
 import random
 
 from faker import Faker
-from sqlalchemy import insert, select
+from sqlalchemy import insert, inspect, select, text
 
 from db import Session, engine
 from models import (
@@ -18,154 +19,190 @@ from models import (
     TeacherClazz,
 )
 
+# NOTE: Faker の生成時にロケールのプロバイダを読み込むため、モジュールで1度だけ生成して各関数で使い回す
 faker = Faker(["ja-JP"])
 
 
-def add_teachers():
-    names = [{"name": f"T{faker.name()}"} for _ in range(30)]
-    stmt = insert(Teacher).values(names)
-    with Session() as session:
-        session.execute(stmt)
-        session.commit()
+def _chunked(rows, size=500):
+    """投入する行を size 件ずつに分割する
 
+    NOTE: 1回の INSERT が大きくなりすぎて MySQL の max_allowed_packet を超えないように分割して投入する
+          ref: https://dev.mysql.com/doc/refman/8.0/en/packet-too-large.html
+    """  # noqa
+    for start in range(0, len(rows), size):
+        end = start + size
+        yield rows[start:end]
+
+
+def _bulk_insert(session, model, rows):
+    """件数の多いテーブルに行をまとめて投入する
+
+    NOTE: PostgreSQL の COPY のような専用の経路は MySQL にはないため、executemany で投入する
+          ref: db.py::engine (pymysql の executemany)
+    """  # noqa
+    stmt = insert(model)
+    for chunk in _chunked(rows):
+        session.execute(stmt, chunk)
 
-def add_class():
-    names = [{"name": f"C{faker.unique.town()}"} for _ in range(10)]
-    stmt = insert(Clazz).values(names)
-    with Session() as session:
-        session.execute(stmt)
-        session.commit()
 
+def add_teachers(session):
+    # 名前をまとめて生成してから、行の dict を組み立てる際にプレフィックスを付ける
+    names = [faker.name() for _ in range(30)]
+    teachers = [{"name": f"T{name}"} for name in names]
+    session.execute(insert(Teacher), teachers)
+    return session.scalars(select(Teacher.id)).all()
 
-def add_club():
+
+def add_class(session):
+    unique_town = faker.unique.town
+    names = [unique_town() for _ in range(10)]
+    classes = [{"name": f"C{name}"} for name in names]
+    session.execute(insert(Clazz), classes)
+    return session.scalars(select(Clazz.id)).all()
+
+
+def add_club(session):
     # TODO: 手直ししたい
-    stmt = insert(Club).values(
-        [
-            {"name": "C野球部", "teacher_id": 1},
-            {"name": "Cサッカー部", "teacher_id": 2},
-            {"name": "Cバスケットボール部", "teacher_id": 3},
-            {"name": "C陸上部", "teacher_id": 4},
-            {"name": "Cバレーボール部", "teacher_id": 5},
-            {"name": "Cテニス部", "teacher_id": 6},
-            {"name": "C硬式テニス部", "teacher_id": 7},
-            {"name": "Cバドミントン部", "teacher_id": 8},
-            {"name": "C吹奏楽部", "teacher_id": 9},
-            {"name": "C美術部", "teacher_id": None},
-        ]
-    )
-    with Session() as session:
-        session.execute(stmt)
-        session.commit()
-
-
-def add_students():
-    students = []
-    for _ in range(300):
-        gender = faker.pyint(min_value=1, max_value=2)
-        students.append(
-            {
-                "name": f"S{faker.name_male()}"
-                if gender == 1
-                else f"S{faker.name_female()}",
-                "gender": gender,
-                "address": faker.address(),
-                "score": faker.pyint(min_value=0, max_value=100),
-            }
-        )
-    stmt = insert(Student).values(students)
-    with Session() as session:
-        session.execute(stmt)
-        session.commit()
-
-
-def add_email():
-    with Session() as session:
-        result = session.execute(select(Student.id))
-        student_ids = result.scalars().all()
-
-    email_list = []
-    for student_id in student_ids:
-        count = faker.pyint(min_value=1, max_value=3)
-        for _ in range(count):
-            email_list.append({"email": faker.email(), "student_id": student_id})
-
-    stmt = insert(Email).values(email_list)
-    with Session() as session:
-        session.execute(stmt)
-        session.commit()
-
-
-def add_teacher_class():
-    with Session() as session:
-        result = session.execute(select(Clazz.id))
-        class_ids = result.scalars().all()
-        result = session.execute(select(Teacher.id))
-        teacher_ids = result.scalars().all()
-
-    teacher_class = []
-    for class_id in class_ids:
-        pickup_teacher_ids = random.sample(
-            teacher_ids, faker.pyint(min_value=1, max_value=3)
-        )
-        for teacher_id in pickup_teacher_ids:
-            teacher_class.append({"teacher_id": teacher_id, "class_id": class_id})
-
-    stmt = insert(TeacherClazz).values(teacher_class)
-    with Session() as session:
-        session.execute(stmt)
-        session.commit()
-
-
-def add_student_class():
-    with Session() as session:
-        result = session.execute(select(Clazz.id))
-        class_ids = result.scalars().all()
-        result = session.execute(select(Student.id))
-        student_ids = result.scalars().all()
-
-    student_class = []
-    for student_id in student_ids:
-        pickup_class_id = random.choice(class_ids)
-        student_class.append({"student_id": student_id, "class_id": pickup_class_id})
-
-    stmt = insert(StudentClazz).values(student_class)
-    with Session() as session:
-        session.execute(stmt)
-        session.commit()
-
-
-def add_student_club():
-    with Session() as session:
-        result = session.execute(select(Club.id))
-        club_ids = result.scalars().all()
-        result = session.execute(select(Student.id))
-        student_ids = result.scalars().all()
-
-    student_club = []
-    for student_id in student_ids:
-        club_count = faker.pyint(min_value=0, max_value=2)
-        pickup_club_ids = random.sample(club_ids, club_count)
-        for club_id in pickup_club_ids:
-            student_club.append({"student_id": student_id, "club_id": club_id})
-
-    stmt = insert(StudentClub).values(student_club)
-    with Session() as session:
-        session.execute(stmt)
-        session.commit()
+    clubs = [
+        {"name": "C野球部", "teacher_id": 1},
+        {"name": "Cサッカー部", "teacher_id": 2},
+        {"name": "Cバスケットボール部", "teacher_id": 3},
+        {"name": "C陸上部", "teacher_id": 4},
+        {"name": "Cバレーボール部", "teacher_id": 5},
+        {"name": "Cテニス部", "teacher_id": 6},
+        {"name": "C硬式テニス部", "teacher_id": 7},
+        {"name": "Cバドミントン部", "teacher_id": 8},
+        {"name": "C吹奏楽部", "teacher_id": 9},
+        {"name": "C美術部", "teacher_id": None},
+    ]
+    session.execute(insert(Club), clubs)
+    return session.scalars(select(Club.id)).all()
+
+
+def add_students(session):
+    # 行ごとに faker を呼び分けずに、性別ごとの名前と住所をまとめて生成しておく
+    genders = random.choices((1, 2), k=300)
+    male_names = iter([faker.name_male() for _ in range(genders.count(1))])
+    female_names = iter([faker.name_female() for _ in range(genders.count(2))])
+    names = [next(male_names) if g == 1 else next(female_names) for g in genders]
+    addresses = [faker.address() for _ in range(300)]
+    scores = [random.randint(0, 100) for _ in range(300)]
+
+    # 列ごとのリストから行の dict を組み立てる
+    students = [
+        {"name": f"S{name}", "gender": gender, "address": address, "score": score}
+        for name, gender, address, score in zip(names, genders, addresses, scores)
+    ]
+    _bulk_insert(session, Student, students)
+    return session.scalars(select(Student.id)).all()
+
+
+def add_email(session, student_ids):
+    # ループ内で faker.unique の属性を毎回たどらないようにメソッドを変数に束縛しておく
+    unique_email = faker.unique.email
+    counts = [random.randint(1, 3) for _ in student_ids]
+    # NOTE: (email, student_id) のユニーク制約があるため重複しないメールアドレスを生成する
+    email_list = [
+        {"email": unique_email(), "student_id": student_id}
+        for student_id, count in zip(student_ids, counts)
+        for _ in range(count)
+    ]
+
+    _bulk_insert(session, Email, email_list)
+
+
+def add_teacher_class(session, class_ids, teacher_ids):
+    teacher_class = [
+        {"teacher_id": teacher_id, "class_id": class_id}
+        for class_id in class_ids
+        for teacher_id in random.sample(teacher_ids, random.randint(1, 3))
+    ]
+
+    session.execute(insert(TeacherClazz), teacher_class)
+
+
+def add_student_class(session, class_ids, student_ids):
+    # 生徒ごとに random.choice を呼ばずに、全生徒分のクラスを1回でまとめて抽選する
+    pickup_class_ids = random.choices(class_ids, k=len(student_ids))
+    student_class = [
+        {"student_id": student_id, "class_id": class_id}
+        for student_id, class_id in zip(student_ids, pickup_class_ids)
+    ]
+
+    session.execute(insert(StudentClazz), student_class)
+
+
+def add_student_club(session, club_ids, student_ids):
+    club_counts = random.choices((0, 1, 2), k=len(student_ids))
+    student_club = [
+        {"student_id": student_id, "club_id": club_id}
+        for student_id, club_count in zip(student_ids, club_counts)
+        for club_id in random.sample(club_ids, club_count)
+    ]
+
+    _bulk_insert(session, StudentClub, student_club)
+
+
+def _is_same_schema():
+    """DB のテーブルとカラムがモデルと一致しているか"""
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            return False
+        columns = {column["name"] for column in inspector.get_columns(table.name)}
+        if columns != set(table.columns.keys()):
+            return False
+    return True
+
+
+def _truncate_tables():
+    """テーブルを drop / create せずにデータのみリセットする
+
+    NOTE: 外部キーで参照されているテーブルは truncate できないため、一時的に外部キーの制約チェックを無効にする。
+          また truncate により AUTO_INCREMENT も 1 に戻る (add_club は teacher_id を 1 からの連番で指定している)
+          ref: https://dev.mysql.com/doc/refman/8.0/en/truncate-table.html
+    """  # noqa
+    with engine.begin() as conn:
+        conn.execute(text("SET FOREIGN_KEY_CHECKS = 0"))
+        # NOTE: 制約チェックを無効にしたままコネクションをプールへ返却しないように、例外時も必ず戻す
+        try:
+            for table in reversed(Base.metadata.sorted_tables):
+                conn.execute(text(f"TRUNCATE TABLE {table.name}"))
+        finally:
+            conn.execute(text("SET FOREIGN_KEY_CHECKS = 1"))
 
 
 def test_seeder():
     """
     ref: https://docs.sqlalchemy.org/en/20/orm/quickstart.html#emit-create-table-ddl
     ref: https://docs.sqlalchemy.org/en/20/core/metadata.html#sqlalchemy.schema.MetaData.create_all
+    ref: https://docs.sqlalchemy.org/en/20/orm/queryguide/dml.html#orm-bulk-insert-statements
+
+    NOTE: `insert(T).values(list)` だと全件を1つの巨大な SQL にコンパイルするため、
+          `session.execute(insert(T), list)` でパラメータとして渡して executemany で投入する
+    NOTE: 環境変数 SEEDER_KEEP_TABLES=1 の場合、テーブルとカラムがモデルと一致していれば
+          drop / create せずに truncate でデータのみリセットする。
+          インデックスやカラムの型の変更は検知しないため、モデルを変更した場合は指定せずに実行する
     """  # noqa
-    Base.metadata.drop_all(engine)
-    Base.metadata.create_all(engine)
-    add_teachers()
-    add_class()
-    add_club()
-    add_students()
-    add_email()
-    add_teacher_class()
-    add_student_class()
-    add_student_club()
+    # NOTE: faker.unique は生成済みの値をモジュールが読み込まれている間ずっと保持するため、
+    #       seeder を繰り返し実行しても重複の再生成が増えないように投入のたびにリセットする。
+    #       clear() は town (add_class) と email (add_email) の両方の履歴を消すため、
+    #       投入の途中ではなく最初に1回だけ呼ぶ
+    faker.unique.clear()
+    if os.getenv("SEEDER_KEEP_TABLES") == "1" and _is_same_schema():
+        _truncate_tables()
+    else:
+        Base.metadata.drop_all(engine)
+        Base.metadata.create_all(engine)
+    # NOTE: 関数ごとに session を作って commit せず、1つのトランザクションでまとめて投入して最後に1回だけ commit する
+    with Session.begin() as session:
+        # NOTE: MySQL は `INSERT ... RETURNING` に対応していないため、投入した ID は投入後に1回だけ select して
+        #       依存するテーブルの投入に引き回す
+        teacher_ids = add_teachers(session)
+        class_ids = add_class(session)
+        club_ids = add_club(session)
+        student_ids = add_students(session)
+        add_email(session, student_ids)
+        add_teacher_class(session, class_ids, teacher_ids)
+        add_student_class(session, class_ids, student_ids)
+        add_student_club(session, club_ids, student_ids)